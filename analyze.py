@@ -1,142 +1,325 @@
 #! /usr/bin/env python
 import argparse
 import csv
+import hashlib
 import logging
-import re
+import os
+import tempfile
+import zipfile
 
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    import polars as pl
+except ImportError:  # polars is optional; fall back to NumPy's parser
+    pl = None
+
 PERCENTILES = [10, 50, 90]
 PERCENTILE_COLORS = ["red", "black", "green"]
 # If True, we will make some assumptions about the data that favor a slightly
 # longer life expectancy.
 OPTIMISTIC_MODE = True
+# The oldest age that deaths are counted at. In optimistic mode, the deaths in
+# the final "100 and over" bucket are spread out over the years up to this age.
+MAX_AGE = 110
 
 _logger = logging.getLogger(__name__)
 
+# The figure and axes are reused across calls to `graph`, see `_get_axes`.
+_FIG = None
+_AX = None
+
+# Parsed data is cached here between runs, see `_cached_get_data`.
+_CACHE_DIR = os.path.expanduser("~/.cache/life-expectancy")
+# Bump this whenever `get_data` changes what it returns, so that data cached by
+# older versions of the script isn't used.
+_CACHE_VERSION = 2
+
+# Matches the lower bound of an age bucket, e.g. "26–27" => 26
+_AGE_PATTERN = r"^(\d+)"
+
+
+def _read_data_with_polars(
+    data_path: str, min_age: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # Build a lazy query so that polars only parses the age and death count
+    # columns and only materializes the rows at or above the minimum age. The
+    # transformations match those in `_read_data_with_numpy`.
+    df = (
+        pl.scan_csv(data_path, schema_overrides={"age": pl.Utf8, "dx": pl.Utf8})
+        .select(
+            pl.col("age").str.extract(_AGE_PATTERN, 1).cast(pl.Int32),
+            pl.col("dx").str.replace_all(",", "").cast(pl.Int64),
+        )
+        # Don't include ages below the minimum, but keep the rows whose age
+        # couldn't be parsed so that they are caught below
+        .filter(pl.col("age").is_null() | (pl.col("age") >= min_age))
+        .collect(engine="streaming")
+    )
+    # Empty or malformed fields become nulls, which would otherwise turn into
+    # NaN in the NumPy arrays. Fail like `_read_data_with_numpy` does instead.
+    if df.null_count().sum_horizontal().item() > 0:
+        raise ValueError(f"Could not parse every age and death count in {data_path}")
+    return df["age"].to_numpy(), df["dx"].to_numpy()
+
+
+def _read_data_with_numpy(
+    data_path: str, min_age: int
+) -> tuple[np.ndarray, np.ndarray]:
+    with open(data_path, encoding="utf-8") as f:
+        # Find the age and death count columns from the CSV headers
+        headers = next(csv.reader(f))
+        # Parse the remaining rows into a 2-D array of strings. Unlike
+        # `np.genfromtxt`, `np.loadtxt` understands quoted fields like "1,218".
+        columns = np.loadtxt(
+            f,
+            dtype=str,
+            delimiter=",",
+            quotechar='"',
+            usecols=(headers.index("age"), headers.index("dx")),
+            ndmin=2,
+        )
+    # "26–27" => "26" and "100 and over" => "100"
+    lower_age_strs = np.char.partition(columns[:, 0], "–")[:, 0]
+    lower_age_strs = np.char.partition(lower_age_strs, " ")[:, 0]
+    ages = lower_age_strs.astype(np.int32)
+    # "1,218" => 1218. Empty or malformed death counts fail to parse.
+    death_counts = np.char.replace(columns[:, 1], ",", "").astype(np.int64)
+    # Don't include ages below the minimum
+    mask = ages >= min_age
+    if not death_counts[mask].any():
+        raise ValueError(f"There is no data for ages {min_age} and above.")
+    return ages[mask], death_counts[mask]
+
 
-def get_data(data_path: str, min_age: int = 0) -> dict[int, int]:
-    # Open CSV file
-    death_count_by_age: dict[int, int] = {}
-    with open(data_path) as f:
-        # Parse the CSV into rows with headers
-        reader = csv.DictReader(f)
-        for row in reader:
-            lower_age_str = re.match(r"(\d+)", row["age"]).group(1)  # "26-27" => 26
-            age = int(lower_age_str)
-            if age < min_age:
-                # Don't include ages below the minimum
-                continue
-            death_count_without_commas = row["dx"].replace(",", "")
-            death_count = int(death_count_without_commas)  # number of deaths column
-            death_count_by_age[age] = death_count
+def _extend_tail(
+    previous_year_death_count: int,
+    deaths_per_year_change_rate: float,
+    remaining_deaths_to_redistribute: int,
+    max_tail_length: int,
+) -> np.ndarray:
+    # Each year's deaths decay geometrically from the previous year's.
+    tail_death_counts = np.floor(
+        previous_year_death_count
+        * deaths_per_year_change_rate ** np.arange(1, max_tail_length + 1)
+    ).astype(np.int64)
+    # Stop at the first year by which all of the remaining deaths have been
+    # accounted for, and give that year whatever deaths are left over. Any
+    # deaths left over after the last year are dropped.
+    cumulative_tail_death_counts = np.cumsum(tail_death_counts)
+    tail_length = min(
+        int(
+            np.searchsorted(
+                cumulative_tail_death_counts, remaining_deaths_to_redistribute
+            )
+        )
+        + 1,
+        max_tail_length,
+    )
+    if cumulative_tail_death_counts[tail_length - 1] >= (
+        remaining_deaths_to_redistribute
+    ):
+        tail_death_counts[tail_length - 1] = remaining_deaths_to_redistribute - (
+            cumulative_tail_death_counts[tail_length - 2] if tail_length > 1 else 0
+        )
+    return tail_death_counts[:tail_length]
+
+
+def get_data(data_path: str, min_age: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    if pl is not None:
+        ages, death_counts = _read_data_with_polars(data_path, min_age)
+    else:
+        ages, death_counts = _read_data_with_numpy(data_path, min_age)
+    # Ages are small integers, so index the death counts directly by age. Ages
+    # without any data, like those above the oldest bucket, have no deaths.
+    death_counts_by_age = np.zeros(MAX_AGE + 1, dtype=np.int64)
+    death_counts_by_age[ages] = death_counts
 
     # If we're in optimistic mode and the deaths in the final bucket are greater
     # than the deaths in the second-to-last bucket, then we'll assume that the
     # data is incomplete and that the deaths in the final bucket are actually
     # decreasing at the same rate as they did from bucket -3 to bucket -2, until
     # there are no deaths left to account for.
-    oldest_death_data: list[tuple[int, int]] = list(death_count_by_age.items())[-3:]
-    if OPTIMISTIC_MODE and oldest_death_data[-1][1] > oldest_death_data[-2][1]:
-        age, remaining_deaths_to_redistribute = oldest_death_data[-1]
+    if OPTIMISTIC_MODE and death_counts[-1] > death_counts[-2]:
+        # Only the three oldest buckets are needed, so read them through a view
+        # of the tail rather than walking the whole histogram.
+        third_oldest_death_count, second_oldest_death_count, oldest_death_count = (
+            death_counts[-3:].tolist()
+        )
+        age = int(ages[-1])
+        remaining_deaths_to_redistribute = oldest_death_count
         if age != 100:
             raise ValueError("Expected the oldest age to be 100.")
-        previous_year_death_count = oldest_death_data[-2][1]  # 5000
+        previous_year_death_count = second_oldest_death_count  # 5000
         _logger.debug(
-            f"Previous year ({oldest_death_data[-2][0]}) death count:",
-            previous_year_death_count,
+            "Previous year (%d) death count: %d", ages[-2], previous_year_death_count
         )
         # This probably isn't a constant, but glancing at the data between ages
         # 90 to 100, it looks somewhat reasonable to assume as an approximation.
         deaths_per_year_change_rate = (
-            oldest_death_data[-2][1] / oldest_death_data[-3][1]
+            second_oldest_death_count / third_oldest_death_count
         )  # 0.7
-        _logger.debug("Deaths per year rate of change:", deaths_per_year_change_rate)
-        while remaining_deaths_to_redistribute > 0:  # 12000
-            _logger.debug(
-                "Remaining deaths to redistribute:", remaining_deaths_to_redistribute
-            )
-            this_year_death_count = min(
-                remaining_deaths_to_redistribute,
-                max(
-                    0,
-                    int(float(previous_year_death_count) * deaths_per_year_change_rate),
-                ),
-            )
+        _logger.debug(
+            "Deaths per year rate of change: %.3f", deaths_per_year_change_rate
+        )
+        # The final bucket is replaced by one bucket per year up to the max age
+        tail_death_counts = _extend_tail(
+            previous_year_death_count,
+            deaths_per_year_change_rate,
+            remaining_deaths_to_redistribute,
+            MAX_AGE - age + 1,
+        )
+        _logger.debug("Redistributed deaths from age %d: %s", age, tail_death_counts)
+        death_counts_by_age[age : age + len(tail_death_counts)] = tail_death_counts
 
-            _logger.debug("Adding", this_year_death_count, "deaths at age", age)
-            death_count_by_age[age] = this_year_death_count
+    return np.arange(min_age, MAX_AGE + 1), death_counts_by_age[min_age:]
+
+
+def _write_cache(cache_path: str, ages: np.ndarray, death_counts: np.ndarray):
+    # Write to a temporary file first and then move it into place, so that an
+    # interrupted run can't leave a partially written cache behind. Caching is
+    # only an optimization, so failing to write the cache isn't an error.
+    temp_path = None
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=_CACHE_DIR, suffix=".npz", delete=False
+        ) as f:
+            temp_path = f.name
+            np.savez(f, ages=ages, death_counts=death_counts)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        _logger.debug("Could not write the cache to %s: %s", cache_path, e)
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
 
-            remaining_deaths_to_redistribute -= this_year_death_count
-            _logger.debug(
-                "remaining deaths to redistribute:", remaining_deaths_to_redistribute
-            )
-            previous_year_death_count = this_year_death_count
-            age += 1
 
-            if age > 110:
-                break
+def _cached_get_data(data_path: str, min_age: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # The data for all ages is cached, keyed on the file's path and modification
+    # time so that editing the CSV invalidates the cache, and on everything else
+    # that affects the output of `get_data`. Changing the minimum age then only
+    # requires slicing the cached arrays.
+    cache_key = hashlib.blake2b(
+        f"{_CACHE_VERSION}:{os.path.abspath(data_path)}:"
+        f"{os.path.getmtime(data_path)}:{OPTIMISTIC_MODE}:{MAX_AGE}".encode()
+    ).hexdigest()[:16]
+    cache_path = os.path.join(_CACHE_DIR, f"{cache_key}.npz")
+    try:
+        with np.load(cache_path) as cached:
+            ages, death_counts = cached["ages"], cached["death_counts"]
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        # The cache is missing or unreadable, e.g. because an earlier run was
+        # interrupted while writing it
+        ages, death_counts = get_data(data_path=data_path, min_age=0)
+        _write_cache(cache_path, ages, death_counts)
+
+    # Don't include ages below the minimum
+    mask = ages >= min_age
+    if not death_counts[mask].any():
+        raise ValueError(f"There is no data for ages {min_age} and above.")
+    return ages[mask], death_counts[mask]
+
+
+def _summarize(
+    ages: np.ndarray,
+    death_counts: np.ndarray,
+    percents: np.ndarray,
+    percentile_age_offset: float,
+) -> tuple[float, float, np.ndarray]:
+    # Compute the weighted mean and variance from the sums of w, w*x and w*x^2,
+    # so the ages and weights are only swept once.
+    weights = death_counts.astype(np.float64)
+    x = ages.astype(np.float64)
+    weighted_x = weights * x
+    s0 = weights.sum()
+    s1 = weighted_x.sum()
+    s2 = np.dot(weighted_x, x)
+    mean = s1 / s0
+    variance = max(0.0, s2 / s0 - mean * mean)
+
+    # Calculate the percentiles of death ages straight from the histogram,
+    # since the government only gave us a summary histogram of deaths. The
+    # percentile age is the first age by which that percent of deaths happened.
+    cumulative_death_counts = np.cumsum(death_counts)
+    percentile_death_counts = percents / 100.0 * cumulative_death_counts[-1]
+    percentile_ages = (
+        x[np.searchsorted(cumulative_death_counts, percentile_death_counts)]
+        + percentile_age_offset
+    )
+    return mean, np.sqrt(variance), percentile_ages
 
-    return death_count_by_age
+
+def _get_axes():
+    # Reuse the previous figure and axes rather than setting up new ones on every
+    # call, unless the previous figure's window has been closed.
+    global _FIG, _AX
+    if _FIG is None or not plt.fignum_exists(_FIG.number):
+        _FIG, _AX = plt.subplots()
+    else:
+        _AX.clear()
+    return _AX
 
 
 def graph(min_age: int, data_path: str):
-    death_count_by_age = get_data(min_age=min_age, data_path=data_path)
-    # Create data from the histogram
-    ages = np.array(list(death_count_by_age.keys()))
-    death_counts = np.array(list(death_count_by_age.values()))
+    ages, death_counts = _cached_get_data(min_age=min_age, data_path=data_path)
     n = death_counts.sum()
-    # Plot the histogram
-    plt.title(f"{data_path} from age {min_age}")
-    plt.bar(ages, death_counts, color="lightblue")
-    plt.xlabel("Age of death")
-    plt.ylabel(f"Number of deaths per {n:,} people")
-
-    mean = np.average(ages, weights=death_counts)
-    variance = np.average((ages - mean) ** 2, weights=death_counts)
-    standard_deviation = np.sqrt(variance)
-
-    # Add sigma label to the plot
-    left_shift = 0
-    plt.text(
+    ax = _get_axes()
+    # Plot the histogram as a single filled path rather than one bar per age.
+    # The bucket edges are shifted by half a year so each age stays centered on
+    # its tick, like a bar would be.
+    ax.set_title(f"{data_path} from age {min_age}")
+    histogram = ax.stairs(
+        death_counts,
+        np.append(ages, ages[-1] + 1) - 0.5,
+        fill=True,
+        color="lightblue",
+        label="Actual deaths per age",
+    )
+    ax.set_xlabel("Age of death")
+    ax.set_ylabel(f"Number of deaths per {n:,} people")
+
+    # NB: We add half a year to every age for the percentiles to make the
+    # distribution account for the fact that people die, on average in the
+    # middle of their age. This is likely not quite true. For example, as we get
+    # closer to 100 years old, it's probably more likely that we die at the
+    # beginning of our age year than at the end of our age year. But this is a
+    # good enough approximation. If we wanted to be pessimistic, we would get rid
+    # of this bonus.
+    mean, standard_deviation, percentiles = _summarize(
+        ages,
+        death_counts,
+        np.array(PERCENTILES, dtype=np.float64),
+        0.5 if OPTIMISTIC_MODE else 0.0,
+    )
+
+    # Add sigma label to the plot, positioned relative to the axes so that it
+    # doesn't depend on the range of the data.
+    ax.text(
         # How far from the left of the plot
-        (ages.max() - ages.min()) * left_shift + ages.min(),
+        0.02,
         # How far from the bottom of the plot
-        death_counts.max() * 0.6,
+        0.6,
         f"$\mu = {mean:.1f}$ years\n"
         f"$\sigma = {standard_deviation:.1f}$ years\n"
         f"$n = {n:,}$ people",
+        transform=ax.transAxes,
     )
 
-    # Create some reconstituted/simulated data to represent each death per year,
-    # since the government only gave us a summary histogram of deaths.
-    # NB: We add half a year to every age to make the distribution account for
-    # the fact that people die, on average in the middle of their age. This is
-    # likely not quite true. For example, as we get closer to 100 years old,
-    # it's probably more likely that we die at the beginning of our age year than
-    # at the end of our age year. But this is a good enough approximation.
-    # If we wanted to be pessimistic, we would get rid of this bonus.
-    reconstituted_death_ages = np.repeat(
-        ages + (0.5 if OPTIMISTIC_MODE else 0), death_counts
-    )
-    # Calculate and show the percentiles of death ages
-    percentiles = [
-        np.percentile(reconstituted_death_ages, q=percentile)
-        for percentile in PERCENTILES
-    ]
-    for percentile, color in zip(percentiles, PERCENTILE_COLORS):
-        plt.bar(percentile, height=death_counts.max() * 0.5, color=color, width=0.4)
-    plt.legend(
-        [
-            "Actual deaths per age",
-            *[
-                f"{name}th percentile age of death: {value:.1f}"
-                for value, name in zip(percentiles, PERCENTILES)
-            ],
+    # Draw all of the percentile markers with a single call. Labelling each bar
+    # gives each one its own legend entry.
+    percentile_markers = ax.bar(
+        percentiles,
+        height=np.full(len(percentiles), death_counts.max() * 0.5),
+        color=PERCENTILE_COLORS,
+        width=0.4,
+        label=[
+            f"{name}th percentile age of death: {value:.1f}"
+            for value, name in zip(percentiles, PERCENTILES)
         ],
-        loc="best",
-        frameon=False,
+    )
+    ax.legend(
+        handles=[histogram, *percentile_markers.patches], loc="best", frameon=False
     )
 
     print(f"Based on the given data and assumptions, someone at age {min_age} has a")
@@ -168,8 +351,19 @@ if __name__ == "__main__":
         default=0,
         help="Data from people who died below this age will be removed from the dataset before analysis.",
     )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+        help="Log debug information about how the data is processed.",
+    )
     options = parser.parse_args()
 
+    logging.basicConfig()
+    if options.verbose:
+        # Only make this script's logging verbose, not that of matplotlib etc.
+        _logger.setLevel(logging.DEBUG)
+
     graph(
         min_age=options.min_age,
         data_path=options.data_path,